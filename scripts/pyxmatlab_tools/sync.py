@@ -1,15 +1,21 @@
 """Sync tools."""
 
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import UTC, datetime
+from functools import cache, lru_cache
+from hashlib import sha256
+from itertools import chain, product
 from json import dumps, loads
 from pathlib import Path
 from platform import platform
-from re import finditer, search
-from shlex import quote, split
-from subprocess import run
+from re import compile as re_compile
+from shlex import join, quote
+from subprocess import PIPE, Popen, run
 from sys import version_info
+from tempfile import TemporaryFile
 
-from pyxmatlab_tools.types import Platform, PythonVersion
+from pyxmatlab_tools.types import LockInputs, Platform, PythonVersion
 
 # ! For local dev config tooling
 PYTEST = Path("pytest.ini")
@@ -32,29 +38,43 @@ OVERRIDE = REQS / "override.txt"
 """Overrides to satisfy otherwise incompatible combinations."""
 
 # ! Platforms and Python versions
-SYS_PLATFORM: Platform = platform(terse=True).casefold().split("-")[0]  # pyright: ignore[reportAssignmentType] 1.1.356
-"""Platform identifier."""
-SYS_PYTHON_VERSION: PythonVersion = ".".join([str(v) for v in version_info[:2]])  # pyright: ignore[reportAssignmentType] 1.1.356
-"""Python version associated with this platform."""
 PLATFORMS: tuple[Platform, ...] = ("linux", "macos", "windows")
 """Supported platforms."""
-PYTHON_VERSIONS: tuple[PythonVersion, ...] = (  # pyright: ignore[reportAssignmentType] 1.1.356
-    tuple(PYTHON_VERSIONS_FILE.read_text("utf-8").splitlines())
-    if PYTHON_VERSIONS_FILE.exists()
-    else ("3.9", "3.10", "3.11", "3.12")
-)
+PYTHON_VERSIONS: tuple[PythonVersion, ...]
 """Supported Python versions."""
+try:
+    PYTHON_VERSIONS = tuple(PYTHON_VERSIONS_FILE.read_text("utf-8").splitlines())  # pyright: ignore[reportAssignmentType] 1.1.356
+except FileNotFoundError:
+    PYTHON_VERSIONS = ("3.9", "3.10", "3.11", "3.12")
 
 # ! Checking
-UV_PAT = r"(?m)^# uv\s(?P<version>.+)$"
+UV_RE = re_compile(r"(?m)^# uv\s(?P<version>.+)$")
 """Pattern for stored `uv` version comment."""
-SUB_PAT = r"(?m)^# submodules/(?P<name>[^\s]+)\s(?P<rev>[^\s]+)$"
+DIGEST_RE = re_compile(r"(?m)^# inputs\s(?P<digest>.+)$")
+"""Pattern for stored digest of compilation inputs comment."""
+SUB_RE = re_compile(r"(?m)^# submodules/(?P<name>[^\s]+)\s(?P<rev>[^\s]+)$")
 """Pattern for stored submodule revision comments."""
-DEP_PAT = r"(?mi)^(?P<name>[A-Z0-9]|[A-Z0-9][A-Z0-9._-]*[A-Z0-9])==.+$"
+DEP_RE = re_compile(r"(?mi)^(?P<name>[A-Z0-9]|[A-Z0-9][A-Z0-9._-]*[A-Z0-9])==.+$")
 """Pattern for compiled dependencies.
 
 See: https://packaging.python.org/en/latest/specifications/name-normalization/#name-format
 """
+EDITABLE_RE = re_compile(r"(?m)^(?:-e|--editable)\s(?P<path>.+)$")
+"""Pattern for editable local dependencies."""
+SUBMODULE_RE = re_compile(r"submodules/.+\b")
+"""Pattern for submodule paths."""
+
+
+@cache
+def get_sys_platform() -> Platform:
+    """Get the platform identifier."""
+    return platform(terse=True).casefold().split("-")[0]  # pyright: ignore[reportReturnType] 1.1.360
+
+
+@cache
+def get_sys_python_version() -> PythonVersion:
+    """Get the Python version associated with this platform."""
+    return ".".join([str(v) for v in version_info[:2]])  # pyright: ignore[reportReturnType] 1.1.360
 
 
 def check_compilation(high: bool = False) -> str:  # noqa: PLR0911
@@ -65,53 +85,106 @@ def check_compilation(high: bool = False) -> str:  # noqa: PLR0911
     high
         Highest dependencies.
     """
-    old = get_compilation(SYS_PLATFORM, SYS_PYTHON_VERSION, high)
+    sys_platform = get_sys_platform()
+    sys_python_version = get_sys_python_version()
+    inputs = get_lock_inputs()
+    old = get_compilation(sys_platform, sys_python_version, high)
     if not old:
-        return lock(high)  # Old compilation missing
-    old_uv = search(UV_PAT, old)
+        return lock(high, inputs=inputs)  # Old compilation missing
+    old_uv = UV_RE.search(old)
     if not old_uv:
-        return lock(high)  # Unknown `uv` version last used to compile
+        return lock(high, inputs=inputs)  # Unknown `uv` version last used to compile
     if old_uv["version"] != get_uv_version():
-        return lock(high)  # Older `uv` version last used to compile
-    directs = compile(SYS_PLATFORM, SYS_PYTHON_VERSION, high, no_deps=True)
-    try:
-        subs = dict(
-            zip(finditer(SUB_PAT, old), finditer(SUB_PAT, directs), strict=False)
-        )
-    except ValueError:
-        return lock(high)  # Submodule missing
-    if any(old_sub.groups() != new_sub.groups() for old_sub, new_sub in subs.items()):
-        return lock(high)  # Submodule pinned commit SHA mismatch
+        return lock(high, inputs=inputs)  # Older `uv` version last used to compile
+    old_subs = {sub["name"]: sub["rev"] for sub in SUB_RE.finditer(old)}
+    subs = {
+        sub.removeprefix("submodules/"): rev for sub, rev in inputs.submodules.items()
+    }
+    if old_subs.keys() != subs.keys():
+        return lock(high, inputs=inputs)  # Submodule missing
+    if old_subs != subs:
+        return lock(high, inputs=inputs)  # Submodule pinned commit SHA mismatch
+    old_digest = DIGEST_RE.search(old)
+    if not high and old_digest and old_digest["digest"] == inputs.digest:
+        return old  # The old lowest compilation was compiled from the same inputs
+    exclude_newer = get_exclude_newer()
+    directs = compile(
+        sys_platform,
+        sys_python_version,
+        high,
+        no_deps=True,
+        inputs=inputs,
+        exclude_newer=exclude_newer,
+    )
+    old_pins = {dep["name"].casefold(): dep.group() for dep in DEP_RE.finditer(old)}
     old_directs: list[str] = []
-    for direct in finditer(DEP_PAT, directs):
-        pat = rf"(?mi)^(?P<name>{direct['name']})==(?P<ver>.+$)"
-        if match := search(pat, old):
-            old_directs.append(match.group())
+    for direct in DEP_RE.finditer(directs):
+        if pin := old_pins.get(direct["name"].casefold()):
+            old_directs.append(pin)
             continue
-        return lock(high)  # Direct dependency missing
-    sys_compilation = compile(SYS_PLATFORM, SYS_PYTHON_VERSION, high)
-    if any(d not in sys_compilation for d in old_directs):
-        return lock(high, sys_compilation)  # Direct dependency version mismatch
+        return lock(high, inputs=inputs)  # Direct dependency missing
+    sys_compilation = compile(
+        sys_platform,
+        sys_python_version,
+        high,
+        inputs=inputs,
+        exclude_newer=exclude_newer,
+    )
+    sys_pins = {dep.group() for dep in DEP_RE.finditer(sys_compilation)}
+    if any(d not in sys_pins for d in old_directs):
+        return lock(  # Direct dependency version mismatch
+            high, sys_compilation, exclude_newer, inputs
+        )
     return old  # The old compilation is compatible
 
 
-def lock(high: bool, sys_compilation: str = "") -> str:
-    """Lock dependencies for all platforms and Python versions."""
+def lock(
+    high: bool,
+    sys_compilation: str = "",
+    exclude_newer: str | None = None,
+    inputs: LockInputs | None = None,
+) -> str:
+    """Lock dependencies for all platforms and Python versions.
+
+    Parameters
+    ----------
+    high
+        Highest dependencies.
+    sys_compilation
+        Existing compilation for this platform and Python version.
+    exclude_newer
+        Exclude packages newer than this timestamp. Defaults to now.
+    inputs
+        Inputs constant during a lock. Read from requirements files if not given.
+    """
     lock_contents: dict[str, str] = {}
-    for platform in PLATFORMS:  # noqa: F402
-        for python_version in PYTHON_VERSIONS:
-            key = get_compilation_key(platform, python_version, high)
-            compilation = compile(platform, python_version, high)
+    inputs = inputs or get_lock_inputs()
+    exclude_newer = exclude_newer or get_exclude_newer()
+    get_uv_version()  # Cache before compiling concurrently
+    with ThreadPoolExecutor() as executor:
+        compilations = {
+            executor.submit(
+                compile, *target, high, inputs=inputs, exclude_newer=exclude_newer
+            ): target
+            for target in product(PLATFORMS, PYTHON_VERSIONS)
+        }
+        for future in as_completed(compilations):
+            platform, python_version = compilations[future]
+            compilation = future.result()
             if (
                 not sys_compilation
-                and platform == SYS_PLATFORM
-                and python_version == SYS_PYTHON_VERSION
+                and platform == get_sys_platform()
+                and python_version == get_sys_python_version()
             ):
                 sys_compilation = compilation
-            lock_contents[key] = compilation
-    get_lockfile(high).write_text(
-        encoding="utf-8", data=dumps(indent=2, sort_keys=True, obj=lock_contents) + "\n"
+            lock_contents[get_compilation_key(platform, python_version, high)] = (
+                compilation
+            )
+    contents = (dumps(indent=2, sort_keys=True, obj=lock_contents) + "\n").encode(
+        "utf-8"
     )
+    get_lockfile(high).write_bytes(contents)
+    load_lockfile.cache_clear()
     return sys_compilation
 
 
@@ -132,10 +205,24 @@ def get_compilation(
     lockfile = get_lockfile(high)
     if not lockfile.exists():
         return ""
-    contents = loads(lockfile.read_text("utf-8"))
+    contents = load_lockfile(lockfile, lockfile.stat().st_mtime_ns)
     return contents.get(get_compilation_key(platform, python_version, high), "")
 
 
+@lru_cache(maxsize=2)
+def load_lockfile(lockfile: Path, mtime: int) -> dict[str, str]:  # noqa: ARG001
+    """Load lockfile contents, cached until the lockfile is modified.
+
+    Parameters
+    ----------
+    lockfile
+        Lockfile to load.
+    mtime
+        Modification time of the lockfile in nanoseconds, invalidating the cache.
+    """
+    return loads(lockfile.read_bytes())
+
+
 def get_compilation_key(
     platform: Platform, python_version: PythonVersion, high: bool
 ) -> str:
@@ -164,8 +251,51 @@ def get_lockfile(high: bool) -> Path:
     return Path(f"lock{'-high' if high else ''}.json")
 
 
+def get_lock_inputs() -> LockInputs:
+    """Get inputs to dependency compilation which are constant during a lock."""
+    dev = DEV.read_text("utf-8")
+    editables = tuple(
+        Path(editable["path"]) / "pyproject.toml"
+        for editable in EDITABLE_RE.finditer(dev)
+    )
+    return LockInputs(
+        editables=editables,
+        submodules=get_submodule_revs(
+            tuple(sub.group() for sub in SUBMODULE_RE.finditer(dev))
+        ),
+        nodeps=NODEPS.read_text("utf-8"),
+        digest=get_digest([DEV, NODEPS, OVERRIDE, PYTHON_VERSIONS_FILE, *editables]),
+    )
+
+
+def get_digest(paths: Iterable[Path]) -> str:
+    """Get a digest of file contents, insensitive to line endings.
+
+    Parameters
+    ----------
+    paths
+        Files to digest. Missing files are digested by path alone.
+    """
+    digest = sha256()
+    for path in paths:
+        digest.update(f"{path.as_posix()}\n".encode())
+        if path.exists():
+            digest.update("\n".join(path.read_text("utf-8").splitlines()).encode())
+    return digest.hexdigest()
+
+
+def get_exclude_newer() -> str:
+    """Get the current time as a timestamp to exclude newer packages from compiling."""
+    return datetime.now(UTC).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
 def compile(  # noqa: A001
-    platform: Platform, python_version: PythonVersion, high: bool, no_deps: bool = False
+    platform: Platform,
+    python_version: PythonVersion,
+    high: bool,
+    no_deps: bool = False,
+    inputs: LockInputs | None = None,
+    exclude_newer: str | None = None,
 ) -> str:
     """Compile system dependencies.
 
@@ -179,63 +309,72 @@ def compile(  # noqa: A001
         Platform to compile for.
     python_version
         Python version to compile for.
+    inputs
+        Inputs constant during a lock. Read from requirements files if not given.
+    exclude_newer
+        Exclude packages newer than this timestamp. Defaults to now.
     """
-    sep = " "
+    inputs = inputs or get_lock_inputs()
+    exclude_newer = exclude_newer or get_exclude_newer()
+    args = [
+        "bin/uv",
+        "pip",
+        "compile",
+        "--exclude-newer",
+        exclude_newer,
+        "--python-platform",
+        platform,
+        "--python-version",
+        python_version,
+        "--resolution",
+        "highest" if high else "lowest-direct",
+        "--override",
+        OVERRIDE.as_posix(),
+        "--all-extras",
+        *(["--no-deps"] if no_deps else []),
+        *[path.as_posix() for path in [DEV, *inputs.editables]],
+    ]
+    # Buffer `stderr` in a file so a full pipe can't block `uv` while streaming
+    with TemporaryFile("w+", encoding="utf-8") as stderr:
+        with Popen(args=args, stdout=PIPE, stderr=stderr, text=True) as process:
+            lines = chain(
+                [f"# uv {get_uv_version()}", f"# inputs {inputs.digest}"],
+                [f"# {sub} {rev}" for sub, rev in inputs.submodules.items()],
+                process.stdout,  # pyright: ignore[reportArgumentType] 1.1.360
+                inputs.nodeps.splitlines(),
+            )
+            compilation = "\n".join(line.strip() for line in lines) + "\n"
+        if process.returncode:
+            stderr.seek(0)
+            raise RuntimeError(f"{join(args)}\n{stderr.read()}")
+    return compilation
+
+
+@lru_cache
+def get_submodule_revs(paths: tuple[str, ...]) -> dict[str, str]:
+    """Get the commit SHAs that submodules are pinned to.
+
+    Parameters
+    ----------
+    paths
+        Paths to the submodules.
+    """
+    if not paths:
+        return {}
     result = run(
-        args=split(
-            sep.join([
-                "bin/uv pip compile",
-                f"--exclude-newer {datetime.now(UTC).isoformat().replace('+00:00', 'Z')}",
-                f"--python-platform {platform} --python-version {python_version}",
-                f"--resolution {'highest' if high else 'lowest-direct'}",
-                f"--override {escape(OVERRIDE)}",
-                f"--all-extras {'--no-deps' if no_deps else ''}",
-                *[
-                    escape(path)
-                    for path in [
-                        DEV,
-                        *[
-                            Path(editable["path"]) / "pyproject.toml"
-                            for editable in finditer(
-                                r"(?m)^(?:-e|--editable)\s(?P<path>.+)$",
-                                DEV.read_text("utf-8"),
-                            )
-                        ],
-                    ]
-                ],
-            ])
-        ),
+        ["git", "rev-parse", *[f"HEAD:{path}" for path in paths]],  # noqa: S603, S607
         capture_output=True,
-        check=False,
+        check=True,
         text=True,
     )
-    if result.returncode:
-        raise RuntimeError(result.stderr)
-    deps = result.stdout
-    submodules = {
-        sub.group(): run(
-            split(f"git rev-parse HEAD:{sub.group()}"),  # noqa: S603
-            capture_output=True,
-            check=True,
-            text=True,
-        ).stdout.strip()
-        for sub in finditer(r"submodules/.+\b", DEV.read_text("utf-8"))
-    }
-    return (
-        "\n".join([
-            f"# uv {get_uv_version()}",
-            *[f"# {sub} {rev}" for sub, rev in submodules.items()],
-            *[line.strip() for line in deps.splitlines()],
-            *[line.strip() for line in NODEPS.read_text("utf-8").splitlines()],
-        ])
-        + "\n"
-    )
+    return dict(zip(paths, result.stdout.splitlines(), strict=True))
 
 
+@lru_cache
 def get_uv_version() -> str:
     """Get the installed version of `uv`."""
     result = run(
-        args=split("bin/uv --version"), capture_output=True, check=False, text=True
+        args=["bin/uv", "--version"], capture_output=True, check=False, text=True
     )
     if result.returncode:
         raise RuntimeError(result.stderr)
@@ -250,4 +389,4 @@ def escape(path: str | Path) -> str:
     path
         Path to escape.
     """
-    return quote(Path(path).as_posix())
+    return quote((path if isinstance(path, Path) else Path(path)).as_posix())
@@ -1,8 +1,22 @@
 """Types."""
 
-from typing import Literal, TypeAlias
+from pathlib import Path
+from typing import Literal, NamedTuple, TypeAlias
 
 Platform: TypeAlias = Literal["linux", "macos", "windows"]
 """Platform."""
 PythonVersion: TypeAlias = Literal["3.9", "3.10", "3.11", "3.12"]
 """Python version."""
+
+
+class LockInputs(NamedTuple):
+    """Inputs to dependency compilation which are constant during a lock."""
+
+    editables: tuple[Path, ...]
+    """Project files of editable local dependencies."""
+    submodules: dict[str, str]
+    """Pinned commit SHAs of submodules, keyed by path."""
+    nodeps: str
+    """Dependencies appended to compilations without compiling their dependencies."""
+    digest: str
+    """Digest of the contents of requirements and editable project files."""